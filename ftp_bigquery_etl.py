@@ -1,54 +1,349 @@
 from google.cloud import bigquery
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, timedelta
 import logging
 import os
-import re
 import ftplib
 import base64
+import json
+import tempfile
+import zlib
+from urllib.parse import urlsplit
 
-# Create a custom logger
+# Create a custom logger, records are formatted by the handler of the runtime
 logger = logging.getLogger(__name__)
-handler = logging.StreamHandler()
-handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+logger.setLevel(logging.INFO)
 
-# The directory for storing temporary files
-gc_write_dir = '/tmp'
+# Configure the output when running without a runtime handler, e.g. locally
+if not logging.getLogger().handlers:
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-# Initialize BigQuery client
-bigquery_client = bigquery.Client()
+# The size of the downloaded data kept in memory before it is rolled over to a temporary file
+spool_max_size = 64 << 20
 
+# The size of the blocks read from the FTP data connection
+ftp_block_size = 1 << 20
 
-def get_file_ftp(host, path_to_file, ftp_configuration):
-    """Copy an existing file from FTP via ftp://*host*/*path_to_file* link to home directory.
+# The number of parallel FTP connections used to download files that do not fit into memory
+ftp_download_workers = 4
+
+# BigQuery client, initialized on first use and reused by warm invocations
+bigquery_client = None
+
+
+def get_bigquery_client():
+    """Get the BigQuery client, initializing it on the first call.
+
+    Returns:
+        bigquery.Client
+    """
+    global bigquery_client
+
+    if bigquery_client is None:
+        bigquery_client = bigquery.Client()
+
+    return bigquery_client
+
+
+class SpooledFile(tempfile.SpooledTemporaryFile):
+    """Spooled temporary file that reports a binary read mode accepted by BigQuery uploads.
+
+    While the data is kept in memory SpooledTemporaryFile reports the 'w+b' mode it was created with,
+    which load_table_from_file rejects as a text mode.
+    """
+
+    @property
+    def mode(self):
+        return 'rb+'
+
+
+class EmptyFileError(Exception):
+    """Raised when the file on the FTP server contains no data."""
+
+
+def connect_ftp(host, ftp_configuration):
+    """Connect to FTP server and log in.
 
     Args:
         host (str): FTP server host.
+        ftp_configuration (dict): FTP configuration.
+
+    Returns:
+        ftplib.FTP
+    """
+    ftp_conn = ftplib.FTP()
+
+    try:
+        ftp_conn.connect(host, ftp_configuration['port'])
+        ftp_conn.login(ftp_configuration['user'], ftp_configuration['password'])
+    except Exception:
+        ftp_conn.close()
+        raise
+
+    return ftp_conn
+
+
+def fetch_range(host, path_to_file, ftp_configuration, start, length, file_descriptor):
+    """Copy *length* bytes of the file starting at *start* offset from FTP to the same offset of a local file.
+
+    Args:
+        host (str): FTP server host.
+        path_to_file (str): The path to the file in FTP server.
+        ftp_configuration (dict): FTP configuration.
+        start (int): The offset of the first byte of the range.
+        length (int): The number of bytes in the range.
+        file_descriptor (int): Descriptor of the local file the range is written to.
+    """
+    with connect_ftp(host, ftp_configuration) as ftp_conn:
+        ftp_conn.voidcmd('TYPE I')
+        with ftp_conn.transfercmd(f'RETR {path_to_file}', rest=start) as data_conn:
+            offset = start
+            end = start + length
+            while offset < end:
+                block = data_conn.recv(min(ftp_block_size, end - offset))
+                if not block:
+                    raise EOFError(f'Data connection closed after {offset - start} of {length} bytes '
+                                   f'of range starting at {start}.')
+                os.pwrite(file_descriptor, block, offset)
+                offset += len(block)
+
+        # The data connection is closed before the end of the file for every range except the last one,
+        # so the server may report the transfer as aborted.
+        try:
+            ftp_conn.voidresp()
+        except ftplib.error_temp:
+            pass
+
+
+def get_ranges_ftp(host, path_to_file, file_size, ftp_configuration, file_descriptor):
+    """Copy the file from FTP to a local file in byte ranges downloaded over parallel connections.
+
+    Args:
+        host (str): FTP server host.
+        path_to_file (str): The path to the file in FTP server.
+        file_size (int): The size of the file in FTP server.
+        ftp_configuration (dict): FTP configuration.
+        file_descriptor (int): Descriptor of the local file the ranges are written to.
+    """
+    range_size = -(-file_size // ftp_download_workers)
+
+    # Leaving the executor waits for all the ranges, so none of them writes to the file after a failure
+    with ThreadPoolExecutor(max_workers=ftp_download_workers) as executor:
+        futures = [executor.submit(fetch_range, host, path_to_file, ftp_configuration, start,
+                                   min(range_size, file_size - start), file_descriptor)
+                   for start in range(0, file_size, range_size)]
+        for future in as_completed(futures):
+            future.result()
+
+
+def skip_first_line(write):
+    """Wrap *write* callback so that the data up to and including the first line break is dropped.
+
+    Args:
+        write (callable): Callback receiving blocks of data.
+
+    Returns:
+        Callback for ftplib.FTP.retrbinary.
+    """
+    header_skipped = False
+
+    def callback(block):
+        nonlocal header_skipped
+
+        if not header_skipped:
+            line_end = block.find(b'\n')
+            if line_end == -1:
+                return
+            block = block[line_end + 1:]
+            header_skipped = True
+
+        write(block)
+
+    return callback
+
+
+class GzipDecompressor:
+    """Callback for ftplib.FTP.retrbinary passing the data of a gzip stream decompressed to *write*.
+
+    Args:
+        write (callable): Callback receiving blocks of data.
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self._decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+
+    def __call__(self, block):
+        self._write(self._decompressor.decompress(block))
+
+        # A gzip stream may consist of several members, each one needs a new decompressor
+        while self._decompressor.eof and self._decompressor.unused_data:
+            unused_data = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+            self._write(self._decompressor.decompress(unused_data))
+
+    def finish(self):
+        """Check that the gzip stream has been received completely.
+
+        Raises:
+            EOFError: The stream ended in the middle of a gzip member.
+        """
+        if not self._decompressor.eof:
+            raise EOFError('Compressed file ended before the end of the gzip stream.')
+
+
+def find_file_ftp(ftp_conn, path_to_file):
+    """Find the file in FTP server, preferring its gzip-compressed variant *path_to_file*.gz.
+
+    Args:
+        ftp_conn (ftplib.FTP): Connection to FTP server.
         path_to_file (str): The path to the file in FTP server.
+
+    Returns:
+        tuple: The path to the file to download and its size, or None if the server doesn't report it.
+    """
+    try:
+        return f'{path_to_file}.gz', ftp_conn.size(f'{path_to_file}.gz')
+    except ftplib.error_perm as error:
+        # Without SIZE command there is no way to tell whether the compressed variant exists
+        if not str(error).startswith('550'):
+            return path_to_file, None
+
+    try:
+        return path_to_file, ftp_conn.size(path_to_file)
+    except ftplib.error_perm:
+        return path_to_file, None
+
+
+def get_file_ftp(host, paths_to_files, ftp_configuration, skip_headers=False):
+    """Copy existing files from FTP via ftp://*host*/*path_to_file* links to a spooled temporary file.
+
+    Files are streamed one after another over a single connection and concatenated. A single file that
+    does not fit into *spool_max_size* is split into byte ranges downloaded over parallel connections,
+    falling back to a single connection when the server refuses the extra ones.
+    The gzip-compressed variant of a file is downloaded when the server has one; it is kept compressed
+    when it is the only file, BigQuery decompresses it on load.
+
+    Args:
+        host (str): FTP server host.
+        paths_to_files (list): The paths to the files in FTP server.
         ftp_configuration (dict): FTP configuration.
+        skip_headers (bool): Drop the header line of every file except the first one.
 
     Returns:
-        Full path to the file that has been downloaded.
+        Spooled temporary file with the downloaded data, rewound to the beginning.
+
+    Raises:
+        EmptyFileError: All the files on the FTP server are empty.
     """
-    # Construct FTP object and get the file from a server
-    with ftplib.FTP(host, user=ftp_configuration['user'], passwd=ftp_configuration['password']) as ftp_conn:
-        filename = re.findall('[^/]*$', path_to_file)[0]
-        with open(filename, 'wb') as wf:
-            ftp_conn.retrbinary(f'RETR {filename}', wf.write)
+    spooled = SpooledFile(max_size=spool_max_size)
+
+    # Construct FTP object and get the files from a server
+    try:
+        with connect_ftp(host, ftp_configuration) as ftp_conn:
+            ftp_conn.voidcmd('TYPE I')
+
+            files = []
+            for path_to_file in paths_to_files:
+                path_to_file, file_size = find_file_ftp(ftp_conn, path_to_file)
+
+                if file_size == 0:
+                    logger.info(f'File {path_to_file} is empty, skipping it.')
+                else:
+                    files.append((path_to_file, file_size))
+
+            if not files:
+                raise EmptyFileError(f'Files {", ".join(paths_to_files)} are empty.')
+
+            if len(files) == 1 and files[0][1] is not None and files[0][1] > spool_max_size:
+                ranged_file = files[0]
+            else:
+                ranged_file = None
+
+                for path_to_file, _ in files:
+                    write = spooled.write
+
+                    # Only a file written after some data has its header dropped, files may turn out empty
+                    # when the server doesn't report their size
+                    if spooled.tell():
+                        # Keep the last line of the previous file separate from the first line of this one
+                        spooled.seek(-1, os.SEEK_END)
+                        if spooled.read(1) != b'\n':
+                            spooled.write(b'\n')
+
+                        if skip_headers:
+                            write = skip_first_line(spooled.write)
+
+                    # Concatenated files are rewritten on the fly, so compressed ones have to be decompressed
+                    if len(files) > 1 and path_to_file.endswith('.gz'):
+                        write = GzipDecompressor(write)
+
+                    ftp_conn.retrbinary(f'RETR {path_to_file}', write, blocksize=ftp_block_size)
+
+                    if isinstance(write, GzipDecompressor):
+                        write.finish()
+
+                    logger.info(f'File {path_to_file} has been successfully received.')
 
-    file_location = f'{gc_write_dir}/{filename}'
-    logger.info(f'File {path_to_file} has been successfully received.')
+        # The control session is closed at this point, so it doesn't count against the connection limit
+        if ranged_file:
+            path_to_file, file_size = ranged_file
 
-    return file_location
+            try:
+                # Requesting the descriptor rolls the spooled file over to disk
+                get_ranges_ftp(host, path_to_file, file_size, ftp_configuration, spooled.fileno())
+            except (ftplib.error_temp, ftplib.error_perm):
+                logger.warning(f'Parallel download of file {path_to_file} failed, '
+                               f'retrying over a single connection.', exc_info=True)
 
+                spooled.seek(0)
+                spooled.truncate()
+                with connect_ftp(host, ftp_configuration) as ftp_conn:
+                    ftp_conn.retrbinary(f'RETR {path_to_file}', spooled.write, blocksize=ftp_block_size)
 
-def load_file_bq(file_path, config):
+            logger.info(f'File {path_to_file} has been successfully received.')
+
+        # The files whose size the server doesn't report turn out to be empty only after the download
+        if not spooled.seek(0, os.SEEK_END):
+            raise EmptyFileError(f'Files {", ".join(paths_to_files)} are empty.')
+    except Exception:
+        spooled.close()
+        raise
+
+    spooled.seek(0)
+
+    return spooled
+
+
+def parse_schema(schema):
+    """Build BigQuery table schema from JSON list of field resources.
+
+    Args:
+        schema (str): JSON list of field resources, e.g. [{"name": "id", "type": "INTEGER"}].
+
+    Returns:
+        list: bigquery.SchemaField objects.
+
+    Raises:
+        ValueError: The schema is not a list of field resources with a name and a type.
+    """
+    fields = json.loads(schema)
+
+    if not isinstance(fields, list):
+        raise ValueError('Schema must be a list of field resources.')
+
+    for field in fields:
+        if not isinstance(field, dict) or 'name' not in field or 'type' not in field:
+            raise ValueError(f'Field resource {field!r} must have a name and a type.')
+
+    return [bigquery.SchemaField.from_api_repr(field) for field in fields]
+
+
+def load_file_bq(file_obj, config):
     """Load data to Google BigQuery table.
 
     Args:
-        file_path (str): Path to the file that has been downloaded.
+        file_obj (file): Binary file object with the data that has been downloaded.
         config (dict): Configuration settings for BigQuery load job.
     """
 
@@ -62,27 +357,31 @@ def load_file_bq(file_path, config):
     job_config.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY)
     job_config.source_format = config['source_format']
     job_config.write_disposition = config['write_disposition']
-    job_config.autodetect = True
+
+    # Use the explicit schema when it is provided to avoid schema detection on the server
+    if config['schema']:
+        job_config.schema = config['schema']
+    else:
+        job_config.autodetect = True
 
     if config['source_format'] == 'CSV':
         job_config.field_delimiter = config['delimiter']
         job_config.skip_leading_rows = 1
 
+    client = get_bigquery_client()
+
     # Load the file into BigQuery table.
-    with open(file_path, 'rb') as f:
-        load_job = bigquery_client.load_table_from_file(f, table_ref, location=config['location'],
-                                                        job_config=job_config)
+    load_job = client.load_table_from_file(file_obj, table_ref, location=config['location'],
+                                           job_config=job_config)
 
     # Waits for the job to complete.
     load_job.result()
 
-    table = bigquery_client.get_table(table_ref)
-
-    logger.info(f'Successfully loaded data to table {table.table_id}. Loaded {table.num_rows} rows.')
+    logger.info(f'Successfully loaded data to table {table_id}. Loaded {load_job.output_rows} rows.')
 
 
 def main(event, context):
-    """Get the file from the ftp server and load data to the BigQuery table.
+    """Get the files from the ftp server and load data to the BigQuery table.
 
     Args:
        event: The special object with Pub/Sub message attributes.
@@ -106,34 +405,66 @@ def main(event, context):
             'delimiter': event['attributes']['delimiter'],
             'source_format': event['attributes']['source_format'].upper(),
             'location': event['attributes']['location'],
-            'write_disposition': event['attributes']['write_disposition'].upper()
+            'write_disposition': event['attributes']['write_disposition'].upper(),
+            'schema': None
         }
 
+        if 'schema' in event['attributes']:
+            try:
+                bq_configuration['schema'] = parse_schema(event['attributes']['schema'])
+            except Exception:
+                logger.exception('Exception occurred while parsing the table schema.')
+                return 'failed'
+
+        if 'files' in event['attributes']:
+            file_names = [file_name.strip() for file_name in event['attributes']['files'].split(',')
+                          if file_name.strip()]
+        else:
+            file_names = [f'{str_yesterday}.csv']
+
+        if not file_names:
+            logger.error('No files to load are given.')
+            return 'failed'
+
+        # The hostname may include the port and be followed by the directory the files are stored in
+        try:
+            url_parts = urlsplit(f"ftp://{event['attributes']['hostname']}")
+            port = url_parts.port or ftplib.FTP_PORT
+        except ValueError:
+            logger.exception('Exception occurred while parsing the FTP hostname.')
+            return 'failed'
+
+        host = url_parts.hostname
+        directory = url_parts.path.strip('/')
+
         ftp_configuration = {
             'user': event['attributes']['user'],
             'password': event['attributes']['password'],
-            'path_to_file': f"ftp://{event['attributes']['hostname']}/{str_yesterday}.csv"
+            'port': port
         }
+        paths = [f'{directory}/{file_name}' if directory else file_name for file_name in file_names]
 
-        host = re.sub('ftp://', '', re.findall('ftp://[^/]*', ftp_configuration['path_to_file'])[0])
-        path = re.sub('/$', '', re.sub(f'ftp://{host}/', '', ftp_configuration['path_to_file']))
-
-        # Go to directory for temporary files
-        os.chdir(gc_write_dir)
-
-        # Get the file from FTP
-        try:
-            ftp_file = get_file_ftp(host, path, ftp_configuration)
-        except Exception:
-            logger.exception('Exception occurred while getting the file from FTP.')
+        if len(paths) > 1 and bq_configuration['source_format'] not in ('CSV', 'NEWLINE_DELIMITED_JSON'):
+            logger.error(f"Files in {bq_configuration['source_format']} format can't be concatenated "
+                         f"into a single load job.")
             return 'failed'
 
+        # Get the files from FTP
         try:
-            load_file_bq(ftp_file, bq_configuration)
+            ftp_file = get_file_ftp(host, paths, ftp_configuration,
+                                    skip_headers=bq_configuration['source_format'] == 'CSV')
+        except EmptyFileError:
+            logger.info(f'Files {", ".join(paths)} are empty, skipping the load.')
+            return 'ok'
         except Exception:
-            logger.exception('Exception occurred while loading data into BigQuery.')
+            logger.exception('Exception occurred while getting the files from FTP.')
             return 'failed'
 
-        os.remove(ftp_file)
+        with ftp_file:
+            try:
+                load_file_bq(ftp_file, bq_configuration)
+            except Exception:
+                logger.exception('Exception occurred while loading data into BigQuery.')
+                return 'failed'
 
     return 'ok'
@@ -0,0 +1,261 @@
+import base64
+import ftplib
+import gzip
+from unittest import mock
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+import pytest
+
+import ftp_bigquery_etl
+
+
+@pytest.fixture
+def bq_configuration():
+    return {
+        'project_id': 'project',
+        'dataset_id': 'dataset',
+        'table_id': 'table',
+        'delimiter': ',',
+        'source_format': 'CSV',
+        'location': 'EU',
+        'write_disposition': 'WRITE_TRUNCATE',
+        'schema': None
+    }
+
+
+@pytest.fixture
+def event():
+    return {
+        'data': base64.b64encode(b'get_ftp_data'),
+        'attributes': {
+            'project_id': 'project',
+            'dataset_id': 'dataset',
+            'table_id': 'table',
+            'delimiter': ',',
+            'source_format': 'csv',
+            'location': 'EU',
+            'write_disposition': 'write_truncate',
+            'user': 'user',
+            'password': 'password',
+            'hostname': 'ftp.example.com'
+        }
+    }
+
+
+@pytest.fixture
+def ftp_configuration():
+    return {
+        'user': 'user',
+        'password': 'password',
+        'port': 21
+    }
+
+
+@pytest.fixture
+def bigquery_client(monkeypatch):
+    client = bigquery.Client(project='project', credentials=AnonymousCredentials())
+    monkeypatch.setattr(ftp_bigquery_etl, 'bigquery_client', client)
+    return client
+
+
+@pytest.fixture
+def ftp_conn():
+    with mock.patch.object(ftplib, 'FTP') as ftp_class:
+        yield ftp_class.return_value.__enter__.return_value
+
+
+class FakeDataConn:
+    """Data connection serving the file from the offset requested with REST."""
+
+    def __init__(self, data, rest):
+        self._data = data[rest:]
+
+    def recv(self, size):
+        block, self._data = self._data[:size], self._data[size:]
+        return block
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.fixture
+def ranged_ftp_conn(monkeypatch, ftp_conn):
+    monkeypatch.setattr(ftp_bigquery_etl, 'spool_max_size', 4)
+    monkeypatch.setattr(ftp_bigquery_etl, 'ftp_download_workers', 4)
+    ftp_conn.size.side_effect = [ftplib.error_perm('550 Not found'), 10]
+    # Ranges closed before the end of the file are reported as aborted
+    ftp_conn.voidresp.side_effect = ftplib.error_temp('426 Transfer aborted')
+    return ftp_conn
+
+
+def test_get_file_ftp_reassembles_ranges(ranged_ftp_conn, ftp_configuration):
+    data = b'0123456789'
+    ranged_ftp_conn.transfercmd.side_effect = lambda cmd, rest: FakeDataConn(data, rest)
+
+    with ftp_bigquery_etl.get_file_ftp('host', ['file.csv'], ftp_configuration) as f:
+        assert f.read() == data
+
+    assert sorted(call.kwargs['rest'] for call in ranged_ftp_conn.transfercmd.call_args_list) == [0, 3, 6, 9]
+    ranged_ftp_conn.retrbinary.assert_not_called()
+
+
+def test_get_file_ftp_fails_on_short_range(ranged_ftp_conn, ftp_configuration):
+    data = b'01234567'
+    ranged_ftp_conn.transfercmd.side_effect = lambda cmd, rest: FakeDataConn(data, rest)
+
+    with pytest.raises(EOFError):
+        ftp_bigquery_etl.get_file_ftp('host', ['file.csv'], ftp_configuration)
+
+
+def test_get_file_ftp_falls_back_to_single_connection(monkeypatch, ftp_conn, ftp_configuration):
+    monkeypatch.setattr(ftp_bigquery_etl, 'spool_max_size', 4)
+    ftp_conn.size.side_effect = [ftplib.error_perm('550 Not found'), 8]
+    ftp_conn.retrbinary.side_effect = lambda cmd, callback, blocksize: callback(b'a,b\n1,2\n')
+
+    with mock.patch.object(ftp_bigquery_etl, 'fetch_range', side_effect=ftplib.error_temp('421 Too many users')):
+        with ftp_bigquery_etl.get_file_ftp('host', ['file.csv'], ftp_configuration) as f:
+            assert f.read() == b'a,b\n1,2\n'
+
+    ftp_conn.retrbinary.assert_called_once()
+
+
+def test_get_file_ftp_concatenates_files(ftp_conn, ftp_configuration):
+    data = {
+        'a.csv': b'h1,h2\r\n1,2',
+        'b.csv.gz': gzip.compress(b'h1,h2\r\n') + gzip.compress(b'3,4\n'),
+        'c.csv': b'h1,h2\n5,6\n'
+    }
+
+    def size(path_to_file):
+        if path_to_file not in data:
+            raise ftplib.error_perm('550 Not found')
+        return len(data[path_to_file])
+
+    def retrbinary(cmd, callback, blocksize):
+        file_data = data[cmd.split(' ', 1)[1]]
+        for start in range(0, len(file_data), 4):
+            callback(file_data[start:start + 4])
+
+    ftp_conn.size.side_effect = size
+    ftp_conn.retrbinary.side_effect = retrbinary
+
+    with ftp_bigquery_etl.get_file_ftp('host', ['a.csv', 'b.csv', 'c.csv'], ftp_configuration,
+                                       skip_headers=True) as f:
+        assert f.read() == b'h1,h2\r\n1,2\n3,4\n5,6\n'
+
+
+def test_get_file_ftp_keeps_header_after_empty_file(ftp_conn, ftp_configuration):
+    data = {'empty.csv': [], 'file.csv': [b'a,b\n', b'1,2\n']}
+
+    def retrbinary(cmd, callback, blocksize):
+        for block in data[cmd.split(' ', 1)[1]]:
+            callback(block)
+
+    ftp_conn.size.side_effect = ftplib.error_perm('500 Unknown command')
+    ftp_conn.retrbinary.side_effect = retrbinary
+
+    with ftp_bigquery_etl.get_file_ftp('host', ['empty.csv', 'file.csv'], ftp_configuration,
+                                       skip_headers=True) as f:
+        assert f.read() == b'a,b\n1,2\n'
+
+
+def test_connect_ftp_uses_configured_port(ftp_configuration):
+    ftp_configuration['port'] = 2121
+
+    with mock.patch.object(ftplib, 'FTP') as ftp_class:
+        ftp_bigquery_etl.connect_ftp('host', ftp_configuration)
+
+    ftp_class.return_value.connect.assert_called_once_with('host', 2121)
+    ftp_class.return_value.login.assert_called_once_with('user', 'password')
+
+
+def test_gzip_decompressor_joins_members():
+    blocks = []
+    decompressor = ftp_bigquery_etl.GzipDecompressor(blocks.append)
+    data = gzip.compress(b'a,b\n') + gzip.compress(b'1,2\n')
+
+    decompressor(data[:5])
+    decompressor(data[5:])
+    decompressor.finish()
+
+    assert b''.join(blocks) == b'a,b\n1,2\n'
+
+
+def test_gzip_decompressor_rejects_truncated_stream():
+    decompressor = ftp_bigquery_etl.GzipDecompressor(lambda block: None)
+    decompressor(gzip.compress(b'a,b\n1,2\n')[:-4])
+
+    with pytest.raises(EOFError):
+        decompressor.finish()
+
+
+def test_load_file_bq_uploads_in_memory_spooled_file(bigquery_client, bq_configuration):
+    spooled = ftp_bigquery_etl.SpooledFile(max_size=ftp_bigquery_etl.spool_max_size)
+    spooled.write(b'a,b\n1,2\n')
+    spooled.seek(0)
+
+    load_job = mock.Mock(output_rows=1)
+    with mock.patch.object(bigquery_client, '_do_resumable_upload') as upload, \
+            mock.patch.object(bigquery_client, 'job_from_resource', return_value=load_job):
+        ftp_bigquery_etl.load_file_bq(spooled, bq_configuration)
+
+    assert upload.call_args.args[0] is spooled
+    load_job.result.assert_called_once_with()
+
+
+def test_load_file_bq_sends_explicit_schema(bigquery_client, bq_configuration):
+    bq_configuration['schema'] = ftp_bigquery_etl.parse_schema('[{"name": "id", "type": "INTEGER"}]')
+    spooled = ftp_bigquery_etl.SpooledFile(max_size=ftp_bigquery_etl.spool_max_size)
+
+    with mock.patch.object(bigquery_client, '_do_resumable_upload') as upload, \
+            mock.patch.object(bigquery_client, 'job_from_resource', return_value=mock.Mock(output_rows=0)):
+        ftp_bigquery_etl.load_file_bq(spooled, bq_configuration)
+
+    load_config = upload.call_args.args[1]['configuration']['load']
+    assert load_config['schema'] == {'fields': [{'name': 'id', 'type': 'INTEGER', 'mode': 'NULLABLE'}]}
+    assert load_config.get('autodetect') is not True
+
+
+def test_main_requests_file_names_verbatim(event):
+    event['attributes'].update(hostname='ftp.example.com/exports', files='report#1.csv, report?2.csv,')
+
+    with mock.patch.object(ftp_bigquery_etl, 'get_file_ftp') as get_file_ftp, \
+            mock.patch.object(ftp_bigquery_etl, 'load_file_bq'):
+        assert ftp_bigquery_etl.main(event, None) == 'ok'
+
+    assert get_file_ftp.call_args.args[:2] == ('ftp.example.com', ['exports/report#1.csv', 'exports/report?2.csv'])
+
+
+def test_main_keeps_port_of_hostname(event):
+    event['attributes']['hostname'] = 'ftp.example.com:2121'
+
+    with mock.patch.object(ftp_bigquery_etl, 'get_file_ftp') as get_file_ftp, \
+            mock.patch.object(ftp_bigquery_etl, 'load_file_bq'):
+        assert ftp_bigquery_etl.main(event, None) == 'ok'
+
+    host, _, ftp_configuration = get_file_ftp.call_args.args
+    assert (host, ftp_configuration['port']) == ('ftp.example.com', 2121)
+
+
+@pytest.mark.parametrize('schema', ['[{"name": "id"', '{"name": "id", "type": "INTEGER"}', '[{"name": "id"}]'])
+def test_main_fails_on_invalid_schema(event, schema):
+    event['attributes']['schema'] = schema
+
+    with mock.patch.object(ftp_bigquery_etl, 'get_file_ftp') as get_file_ftp:
+        assert ftp_bigquery_etl.main(event, None) == 'failed'
+
+    get_file_ftp.assert_not_called()
+
+
+def test_main_skips_load_of_empty_file_without_size(event, ftp_conn):
+    ftp_conn.size.side_effect = ftplib.error_perm('500 Unknown command')
+
+    with mock.patch.object(ftp_bigquery_etl, 'load_file_bq') as load_file_bq:
+        assert ftp_bigquery_etl.main(event, None) == 'ok'
+
+    ftp_conn.retrbinary.assert_called_once()
+    load_file_bq.assert_not_called()